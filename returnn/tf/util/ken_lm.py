@@ -27,6 +27,7 @@ def kenlm_checked_out():
 # https://github.com/tensorflow/tensorflow/blob/master/tensorflow/core/lib/strings/str_util.h
 _src_code = """
 #include <exception>
+#include <unordered_map>
 #include "tensorflow/core/framework/op.h"
 #include "tensorflow/core/framework/op_kernel.h"
 #include "tensorflow/core/framework/shape_inference.h"
@@ -37,6 +38,8 @@ _src_code = """
 #include "tensorflow/core/platform/mutex.h"
 #include "tensorflow/core/platform/types.h"
 #include "tensorflow/core/public/version.h"
+#include "tensorflow/core/util/work_sharder.h"
+#include "lm/model.hh"
 
 
 using namespace tensorflow;
@@ -50,12 +53,20 @@ using tstring = tensorflow::tstring;
 
 REGISTER_OP("KenLmLoadModel")
 .Attr("filename: string")
+.Attr("cache_size: int = 0")
+.Attr("model_type: {'probing', 'rest_probing', 'trie'} = 'probing'")
 .Attr("container: string = ''")
 .Attr("shared_name: string = ''")
 .Output("handle: resource")
 .SetIsStateful()
 .SetShapeFn(shape_inference::ScalarShape)
-.Doc("KenLmLoadModel: loads KenLM model, creates TF resource, persistent across runs in the session");
+.Doc("KenLmLoadModel: loads KenLM model, creates TF resource, persistent across runs in the session."
+  " cache_size: max num of cached text scores (e.g. for beam search, where the same texts are scored often)."
+  " 0 disables the cache."
+  " model_type: the KenLM data structure. 'probing' (hash tables) is the fastest."
+  " 'rest_probing' additionally stores rest costs for lower-order n-grams, which are only used for scoring"
+  " partial contexts, not for the full sentence scores here. 'trie' needs less memory but is slower."
+  " For a binary model file, this must match the type it was built with.");
 
 
 REGISTER_OP("KenLmAbsScoreStrings")
@@ -104,39 +115,238 @@ REGISTER_OP("KenLmAbsScoreBpeStringsDense")
   " dense output, for all possible succeeding labels.");
 
 
+// log(10), to convert from +log10 space (KenLM) to (natural) +log space.
+// logf is not constexpr, thus we hardcode it.
+static constexpr float kLn10 = 2.302585092994046f;
+
+
+// Rough cost estimate (in cycles) for scoring one string, used for sharding the batch over threads.
+// Hash probe + sum per word, where we approximate the num of words by the avg string length.
+static int64 EstimateScoreCostPerString(const ::tstring* strings, int64 n, int64 num_extra_words = 0) {
+  const int64 kCyclesPerWord = 200;
+  const int64 kAvgBytesPerWord = 6;
+  int64 total_bytes = 0;
+  for(int64 i = 0; i < n; ++i)
+    total_bytes += strings[i].size();
+  int64 avg_num_words = 1;
+  if(n > 0)
+    avg_num_words += total_bytes / (n * kAvgBytesPerWord);
+  return (avg_num_words + num_extra_words) * kCyclesPerWord;
+}
+
+
 // https://github.com/kpu/kenlm/blob/master/lm/model.hh
 // https://github.com/kpu/kenlm/blob/master/lm/virtual_interface.hh
 // https://github.com/kpu/kenlm/blob/master/python/kenlm.pyx
+// Common interface for the different KenLM model types (see KenLmModelImpl below).
+// The virtual dispatch is once per string, the inner loop over the words is specialized per model type.
 struct KenLmModel : public ResourceBase {
-  explicit KenLmModel(const string& filename)
-      : filename_(filename), model_(filename.c_str()) {}
+  KenLmModel(const string& filename, const string& model_type, int64 cache_size)
+      : filename_(filename), model_type_(model_type), cache_size_(cache_size) {}
+
+  // Scores texts[0..n) into out[0..n), sharded over the workers. Returns in (natural) +log space.
+  // bpe_merge_symbol: if not null, the texts are BPE-merged (see abs_score_bpe_log10).
+  // One call per batch, such that the conversion to +log space is a single (vectorized) loop over the output.
+  __attribute__((hot))
+  void abs_score_batch(
+        const ::tstring* texts, int64 n, const tensorflow::StringPiece* bpe_merge_symbol,
+        const DeviceBase::CpuWorkerThreads& workers, float* out) const {
+    Shard(
+      workers.num_threads, workers.workers, n, EstimateScoreCostPerString(texts, n),
+      [&](int64 begin, int64 end) {
+        for(int64 i = begin; i < end; ++i) {
+          const tensorflow::StringPiece text(texts[i].data(), texts[i].size());
+          out[i] = bpe_merge_symbol ? abs_score_bpe_log10(text, *bpe_merge_symbol) : abs_score_log10(text);
+        }
+        // KenLM returns score in +log10 space.
+        // We want to return in (natural) +log space.
+        // 10 ** x = e ** (x * log(10))
+        for(int64 i = begin; i < end; ++i)
+          out[i] *= kLn10;
+      });
+  }
+
+  // Returns in +log10 space.
+  float abs_score_log10(tensorflow::StringPiece text) const {
+    if(cache_size_ <= 0)
+      return abs_score_log10_uncached(text);
+    return cached_score(strings::StrCat("s:", text), [&]() { return abs_score_log10_uncached(text); });
+  }
+
+  // Like the BPE merging via str_util::StringReplace(text, bpe_merge_symbol + " ", ""),
+  // then str_util::RemoveWhitespaceContext, and then abs_score_log10,
+  // but this merges the subwords on-the-fly without materializing the merged text.
+  float abs_score_bpe_log10(tensorflow::StringPiece text, tensorflow::StringPiece bpe_merge_symbol) const {
+    if(cache_size_ <= 0)
+      return abs_score_bpe_log10_uncached(text, bpe_merge_symbol);
+    return cached_score(
+      strings::StrCat("b", bpe_merge_symbol.size(), ":", bpe_merge_symbol, text),
+      [&]() { return abs_score_bpe_log10_uncached(text, bpe_merge_symbol); });
+  }
+
+  virtual float abs_score_log10_uncached(tensorflow::StringPiece text) const = 0;
+  virtual float abs_score_bpe_log10_uncached(
+        tensorflow::StringPiece text, tensorflow::StringPiece bpe_merge_symbol) const = 0;
+
+  // See KenLmModelImpl::abs_score_dense.
+  virtual float abs_score_dense(
+        const ::tstring& text, const ::tstring& last_word_join,
+        const TTypes<::tstring>::ConstFlat labels, TTypes<float>::UnalignedFlat out_dense_scores) const = 0;
+
+  string DebugString()
+#if (TF_MAJOR_VERSION == 1 && TF_MINOR_VERSION >= 14) || (TF_MAJOR_VERSION > 1)
+const
+#endif
+  override {
+    return strings::StrCat("KenLmModel[", filename_, ", ", model_type_, "]");
+  }
+
+  const string filename_;
+  const string model_type_;
+  const int64 cache_size_;
+
+ private:
+  // The score func is only called if the key was not found in the cache.
+  template<typename ScoreFunc>
+  float cached_score(const std::string& key, const ScoreFunc& score_func) const {
+    {
+      tf_shared_lock l(cache_mu_);
+      auto it = cache_.find(key);
+      if(it != cache_.end())
+        return it->second;
+    }
+    float score = score_func();
+    {
+      mutex_lock l(cache_mu_);
+      // Simple bounded cache: when it is full, just start again.
+      if(cache_.size() >= (size_t) cache_size_)
+        cache_.clear();
+      cache_.emplace(key, score);
+    }
+    return score;
+  }
+
+  // key (see abs_score_log10, abs_score_bpe_log10) -> score (+log10 space), guarded by cache_mu_.
+  // The cache is an optimization only, thus mutable.
+  mutable mutex cache_mu_;
+  mutable std::unordered_map<std::string, float> cache_;
+};
+
+
+// Model: lm::ngram::ProbingModel, lm::ngram::RestProbingModel, lm::ngram::TrieModel.
+// All of them share lm::ngram::State, but the vocab and the search differ.
+template<typename Model>
+struct KenLmModelImpl : public KenLmModel {
+  KenLmModelImpl(const string& filename, const string& model_type, int64 cache_size)
+      : KenLmModel(filename, model_type, cache_size), model_(filename.c_str()) {}
 
-  float abs_score(const ::tstring& text) {
+  float abs_score_log10_uncached(tensorflow::StringPiece text) const override {
     float total = 0;
-    mutex_lock l(mu_);
-    lm::ngram::State state, out_state;
-    model_.BeginSentenceWrite(&state);
-    for(const string& word : tensorflow::str_util::Split(text, ' ')) {
-      if(word.empty()) continue;
-      auto word_idx = model_.BaseVocabulary().Index(word);
-      total += model_.FullScore(state, word_idx, out_state).prob;
-      state = out_state;
+    lm::ngram::State states[2];
+    int cur = 0;
+    model_.BeginSentenceWrite(&states[cur]);
+    // Split by ' ' in-place, without copying each word.
+    const char* p = text.data();
+    const char* const end = p + text.size();
+    while(p < end) {
+      const char* q = p;
+      while(q < end && *q != ' ') ++q;
+      if(TF_PREDICT_TRUE(q > p))  // empty words (multiple spaces) are rare
+        total += score_word(p, q - p, states, &cur);
+      p = q + 1;
     }
-    // KenLM returns score in +log10 space.
-    // We want to return in (natural) +log space.
-    // 10 ** x = e ** (x * log(10))
-    return total * logf(10.);
+    return total;
+  }
+
+  float abs_score_bpe_log10_uncached(
+        tensorflow::StringPiece text, tensorflow::StringPiece bpe_merge_symbol) const override {
+    if(bpe_merge_symbol.find(' ') != tensorflow::StringPiece::npos) {
+      // The on-the-fly merging below assumes that the merge symbol does not contain a space.
+      std::string merged = tensorflow::str_util::StringReplace(
+        text, strings::StrCat(bpe_merge_symbol, " "), "", /* replace_all */ true);
+      tensorflow::StringPiece sp(merged);
+      tensorflow::str_util::RemoveWhitespaceContext(&sp);
+      return abs_score_log10_uncached(sp);
+    }
+    const char* const begin = text.data();
+    const char* const end = begin + text.size();
+    // First pass: the range of the merged text after removing the surrounding whitespace, in terms of the input.
+    const char* kept_begin = end;
+    const char* kept_end = begin;
+    for_each_bpe_piece(text, bpe_merge_symbol, [&](const char* p, const char* q, const char* content_end) {
+      for(const char* c = p; c < content_end; ++c) {
+        if(isspace((unsigned char) *c)) continue;
+        if(kept_begin == end) kept_begin = c;
+        kept_end = c + 1;
+      }
+    });
+    // Second pass: score the merged words.
+    // Words which are not merged (the common case) are directly taken from the input.
+    float total = 0;
+    lm::ngram::State states[2];
+    int cur = 0;
+    model_.BeginSentenceWrite(&states[cur]);
+    std::string word_buf;
+    bool in_merge = false;
+    for_each_bpe_piece(text, bpe_merge_symbol, [&](const char* p, const char* q, const char* content_end) {
+      const bool merge_next = content_end != q;
+      const char* piece_begin = std::max(p, kept_begin);
+      const char* piece_end = std::min(content_end, kept_end);
+      const size_t piece_len = piece_begin < piece_end ? piece_end - piece_begin : 0;
+      if(in_merge || merge_next) {
+        if(!in_merge) word_buf.clear();
+        word_buf.append(piece_begin, piece_len);
+        in_merge = merge_next;
+        if(!in_merge && !word_buf.empty())
+          total += score_word(word_buf.data(), word_buf.size(), states, &cur);
+      }
+      else if(TF_PREDICT_TRUE(piece_len > 0))
+        total += score_word(piece_begin, piece_len, states, &cur);
+    });
+    return total;
+  }
+
+  // Iterates over all ' '-separated pieces [p, q) of the text, including empty ones.
+  // The content of a piece is [p, content_end), which excludes the BPE merge symbol
+  // if it is followed by a space, i.e. when it gets merged with the next piece.
+  template<typename PieceFunc>
+  static void for_each_bpe_piece(
+        tensorflow::StringPiece text, tensorflow::StringPiece bpe_merge_symbol, const PieceFunc& func) {
+    const char* const end = text.data() + text.size();
+    const size_t merge_len = bpe_merge_symbol.size();
+    const char* p = text.data();
+    while(true) {
+      const char* q = p;
+      while(q < end && *q != ' ') ++q;
+      const char* content_end = q;
+      if(merge_len > 0 && q < end && (size_t) (q - p) >= merge_len
+          && memcmp(q - merge_len, bpe_merge_symbol.data(), merge_len) == 0)
+        content_end = q - merge_len;
+      func(p, q, content_end);
+      if(q >= end) break;
+      p = q + 1;
+    }
+  }
+
+  // Scores the next word given states[*cur], writes the new state to states[*cur ^ 1] and flips *cur.
+  // Ping-ponging between the two states avoids copying the State after every word. Returns in +log10 space.
+  float score_word(const char* word, size_t len, lm::ngram::State states[2], int* cur) const {
+    // The KenLM vocab (::StringPiece, not tensorflow::StringPiece) directly hashes the char range.
+    auto word_idx = model_.GetVocabulary().Index(::StringPiece(word, len));
+    float score = model_.FullScore(states[*cur], word_idx, states[*cur ^ 1]).prob;
+    *cur ^= 1;
+    return score;
   }
 
   // See comments below.
   // We expect that the text either ends with a space or not, i.e. "... word " or "... subword".
   float abs_score_dense(
         const ::tstring& text, const ::tstring& last_word_join,
-        const TTypes<::tstring>::ConstFlat labels, TTypes<float>::UnalignedFlat out_dense_scores) {
+        const TTypes<::tstring>::ConstFlat labels, TTypes<float>::UnalignedFlat out_dense_scores) const override {
     assert(labels.size() == out_dense_scores.size());
-    mutex_lock l(mu_);
-    lm::ngram::State state, out_state;
-    model_.BeginSentenceWrite(&state);
+    lm::ngram::State states[2];
+    int cur = 0;
+    model_.BeginSentenceWrite(&states[cur]);
     // We expect that the text either ends with a space or not, i.e. "... word " or "... subword".
     // We split the text into words. In the first case, we would have an empty word at the end, otherwise not.
     auto words = tensorflow::str_util::Split(text, ' ');
@@ -146,41 +356,48 @@ struct KenLmModel : public ResourceBase {
       last_word = words[words.size() - 1];
       // Only up to the last word, which is either empty or a subword, which we join below.
       for(int i = 0; i < words.size() - 1; ++i) {
-        auto word = words[i];
-        if(word.empty()) continue;
-        auto word_idx = model_.BaseVocabulary().Index(word);
-        total_score += model_.FullScore(state, word_idx, out_state).prob;
-        state = out_state;
+        const auto& word = words[i];
+        if(TF_PREDICT_FALSE(word.empty())) continue;
+        total_score += score_word(word.data(), word.size(), states, &cur);
       }
     }
+    // All the following scores are from the same context, thus states[cur ^ 1] is just scratch space.
+    const lm::ngram::State& state = states[cur];
+    lm::ngram::State& out_state = states[cur ^ 1];
     for(int i = 0; i < labels.size(); ++i) {
       ::tstring word = last_word + labels(i);
-      auto word_idx = model_.BaseVocabulary().Index(word);
+      auto word_idx = model_.GetVocabulary().Index(::StringPiece(word.data(), word.size()));
       float score = model_.FullScore(state, word_idx, out_state).prob;
-      out_dense_scores(i) = (total_score + score) * logf(10.);
+      out_dense_scores(i) = (total_score + score) * kLn10;
     }
     // Return the score from the prev step.
     if(!last_word.empty()) {
-      auto word_idx = model_.BaseVocabulary().Index(last_word + last_word_join);
+      ::tstring word = last_word + last_word_join;
+      auto word_idx = model_.GetVocabulary().Index(::StringPiece(word.data(), word.size()));
       total_score += model_.FullScore(state, word_idx, out_state).prob;
     }
-    return total_score * logf(10.);
+    return total_score * kLn10;
   }
 
-  string DebugString()
-#if (TF_MAJOR_VERSION == 1 && TF_MINOR_VERSION >= 14) || (TF_MAJOR_VERSION > 1)
-const
-#endif
-  override {
-    return strings::StrCat("KenLmModel[", filename_, "]");
-  }
-
-  const string filename_;
-  mutex mu_;
-  lm::ngram::ProbingModel model_;
+  // Querying the model is thread-safe (the state is kept by the caller), thus no mutex needed here.
+  const Model model_;
 };
 
 
+// model_type: see KenLmLoadModel.
+static Status NewKenLmModel(const string& filename, const string& model_type, int64 cache_size, KenLmModel** ret) {
+  if(model_type == "probing")
+    *ret = new KenLmModelImpl<lm::ngram::ProbingModel>(filename, model_type, cache_size);
+  else if(model_type == "rest_probing")
+    *ret = new KenLmModelImpl<lm::ngram::RestProbingModel>(filename, model_type, cache_size);
+  else if(model_type == "trie")
+    *ret = new KenLmModelImpl<lm::ngram::TrieModel>(filename, model_type, cache_size);
+  else
+    return errors::InvalidArgument("Unknown model_type ", model_type);
+  return Status();
+}
+
+
 // https://github.com/tensorflow/tensorflow/blob/master/tensorflow/core/framework/resource_op_kernel.h
 // TFUtil.TFArrayContainer
 class KenLmLoadModelOp : public ResourceOpKernel<KenLmModel> {
@@ -188,6 +405,8 @@ class KenLmLoadModelOp : public ResourceOpKernel<KenLmModel> {
   explicit KenLmLoadModelOp(OpKernelConstruction* context)
       : ResourceOpKernel(context) {
     OP_REQUIRES_OK(context, context->GetAttr("filename", &filename_));
+    OP_REQUIRES_OK(context, context->GetAttr("cache_size", &cache_size_));
+    OP_REQUIRES_OK(context, context->GetAttr("model_type", &model_type_));
   }
 
  private:
@@ -195,8 +414,9 @@ class KenLmLoadModelOp : public ResourceOpKernel<KenLmModel> {
   virtual void Cancel() {}
 
   Status CreateResource(KenLmModel** ret) override {
+    *ret = nullptr;
     try {
-      *ret = new KenLmModel(filename_);
+      TF_RETURN_IF_ERROR(NewKenLmModel(filename_, model_type_, cache_size_, ret));
     } catch (std::exception& exc) {
       return errors::Internal("Could not load KenLmModel ", filename_, ", exception: ", exc.what());
     }
@@ -209,10 +429,18 @@ class KenLmLoadModelOp : public ResourceOpKernel<KenLmModel> {
     if(lm->filename_ != filename_)
       return errors::InvalidArgument("Filename mismatch: expected ", filename_,
                                      " but got ", lm->filename_, ".");
+    if(lm->model_type_ != model_type_)
+      return errors::InvalidArgument("Model type mismatch: expected ", model_type_,
+                                     " but got ", lm->model_type_, ".");
+    if(lm->cache_size_ != cache_size_)
+      return errors::InvalidArgument("Cache size mismatch: expected ", cache_size_,
+                                     " but got ", lm->cache_size_, ".");
     return Status();
   }
 
   string filename_;
+  string model_type_;
+  int64 cache_size_;
 };
 
 REGISTER_KERNEL_BUILDER(Name("KenLmLoadModel").Device(DEVICE_CPU), KenLmLoadModelOp);
@@ -238,9 +466,9 @@ class KenLmAbsScoreStringsOp : public OpKernel {
     OP_REQUIRES_OK(context, context->allocate_output(0, input_tensor.shape(), &output_tensor));
     auto output_flat = output_tensor->flat<float>();
 
-    for(int i = 0; i < input_flat.size(); ++i) {
-      output_flat(i) = lm->abs_score(input_flat(i));
-    }
+    lm->abs_score_batch(
+      input_flat.data(), input_flat.size(), nullptr, *context->device()->tensorflow_cpu_worker_threads(),
+      output_flat.data());
   }
 };
 
@@ -265,6 +493,7 @@ class KenLmAbsScoreBpeStringsOp : public OpKernel {
         "bpe_merge_symbol must be a single element but got shape ",
         context->input(1).shape().DebugString()));
     const auto& bpe_merge_symbol = context->input(1).flat<::tstring>()(0);
+    const tensorflow::StringPiece bpe_merge_symbol_sp(bpe_merge_symbol.data(), bpe_merge_symbol.size());
 
     const Tensor& input_tensor = context->input(2);
     auto input_flat = input_tensor.flat<::tstring>();
@@ -273,15 +502,9 @@ class KenLmAbsScoreBpeStringsOp : public OpKernel {
     OP_REQUIRES_OK(context, context->allocate_output(0, input_tensor.shape(), &output_tensor));
     auto output_flat = output_tensor->flat<float>();
 
-    for(int i = 0; i < input_flat.size(); ++i) {
-      ::tstring text = input_flat(i);
-      if(!bpe_merge_symbol.empty())
-        text = tensorflow::str_util::StringReplace(text, bpe_merge_symbol + " ", "", /* replace_all */ true);
-      tensorflow::StringPiece sp(text);
-      tensorflow::str_util::RemoveWhitespaceContext(&sp);
-      text = std::string(sp.data(), sp.size());
-      output_flat(i) = lm->abs_score(text);
-    }
+    lm->abs_score_batch(
+      input_flat.data(), input_flat.size(), &bpe_merge_symbol_sp, *context->device()->tensorflow_cpu_worker_threads(),
+      output_flat.data());
   }
 };
 
@@ -328,13 +551,20 @@ class KenLmAbsScoreBpeStringsDenseOp : public OpKernel {
         TensorShape({input_tensor.NumElements(), labels_tensor.NumElements()})),
       errors::Internal("CopyFrom failed"));
 
-    for(int i = 0; i < input_flat.size(); ++i) {
-      ::tstring text = input_flat(i);
-      if(!bpe_merge_symbol.empty())
-        text = tensorflow::str_util::StringReplace(text, bpe_merge_symbol + " ", "", /* replace_all */ true);
-      output_flat(i) = lm->abs_score_dense(
-        text, bpe_merge_symbol, labels_flat, output_dense_flat_tensor.Slice(i, i + 1).unaligned_flat<float>());
-    }
+    // Each string writes to its own slice of the dense output, so we can shard it as well.
+    auto workers = context->device()->tensorflow_cpu_worker_threads();
+    Shard(
+      workers->num_threads, workers->workers, input_flat.size(),
+      EstimateScoreCostPerString(input_flat.data(), input_flat.size(), labels_flat.size()),
+      [&](int64 begin, int64 end) {
+        for(int64 i = begin; i < end; ++i) {
+          ::tstring text = input_flat(i);
+          if(!bpe_merge_symbol.empty())
+            text = tensorflow::str_util::StringReplace(text, bpe_merge_symbol + " ", "", /* replace_all */ true);
+          output_flat(i) = lm->abs_score_dense(
+            text, bpe_merge_symbol, labels_flat, output_dense_flat_tensor.Slice(i, i + 1).unaligned_flat<float>());
+        }
+      });
   }
 };
 
@@ -351,12 +581,160 @@ _kenlm_src_code_workarounds = """
 """
 
 
+# Run in a separate process (see :func:`_pgo_train`), as the profile data is only written at process exit.
+_pgo_train_script = """
+import sys
+import tensorflow as tf
+
+lib_filename, lm_filename, corpus_filename, batch_size = sys.argv[1:]
+batch_size = int(batch_size)
+mod = tf.load_op_library(lib_filename)
+with tf.Graph().as_default():
+    strings = tf.compat.v1.placeholder(tf.string, [None])
+    scores = mod.ken_lm_abs_score_strings(handle=mod.ken_lm_load_model(filename=lm_filename), strings=strings)
+    with tf.compat.v1.Session() as session:
+        with open(corpus_filename, encoding="utf8") as f:
+            lines = [line.strip() for line in f]
+        for i in range(0, len(lines), batch_size):
+            session.run(scores, feed_dict={strings: lines[i : i + batch_size]})
+"""
+
+
+def _pgo_train(compiler, lm_filename, corpus_filename, batch_size=100, verbose=False):
+    """
+    Runs the instrumented lib over the corpus, which writes the profile data.
+
+    :param returnn.tf.util.basic.OpCodeCompiler compiler: with profile_generate=True
+    :param str lm_filename: ARPA or KenLM binary (probing) file
+    :param str corpus_filename: text file, one sentence per line, white-space delimited words
+    :param int batch_size: num of sentences per op call
+    :param bool verbose:
+    """
+    from subprocess import check_call
+
+    assert compiler.profile_generate
+    cmd = [sys.executable, "-c", _pgo_train_script, compiler.get_lib_filename(), lm_filename, corpus_filename]
+    cmd += [str(batch_size)]
+    if verbose:
+        print("KenLM PGO: gather profile data on %r with LM %r" % (corpus_filename, lm_filename))
+    check_call(cmd)
+    assert compiler.get_profile_data_files(), "KenLM PGO: no profile data written by %r" % compiler
+
+
+# Part of the cache key of _get_extra_sources. Increase this whenever _make_extra_sources changes its output.
+_extra_sources_format_version = 1
+
+
+def _make_extra_sources(files):
+    """
+    Each KenLM source file is its own translation unit, such that they can be compiled in parallel.
+    This also avoids symbol clashes between the files (e.g. their static kConverter).
+
+    :param list[str] files: KenLM .cc files
+    :return: filename -> source code, for :class:`OpCodeCompiler` extra_sources
+    :rtype: dict[str,str]
+    """
+    extra_sources = {}
+    for fn in files:
+        with open(fn, "rb") as f:
+            f_code = f.read().decode("ascii", errors="ignore")  # enforce ASCII, without a per-char Python loop
+        src_code = _kenlm_src_code_workarounds
+        # https://gcc.gnu.org/onlinedocs/cpp/Line-Control.html#Line-Control
+        src_code += '#line 1 "%s"\n' % os.path.basename(fn)
+        src_code += f_code
+        extra_sources[os.path.relpath(fn, kenlm_dir).replace("/", "_")] = src_code
+    return extra_sources
+
+
+def _get_extra_sources(files, verbose=False):
+    """
+    Like :func:`_make_extra_sources`, but cached on disk,
+    keyed by the file paths with their mtime and size,
+    such that a new process reads a single file instead of all the KenLM files.
+    Cache files which were not used for a while are removed,
+    like the old ops in :class:`NativeCodeCompiler`.
+
+    :param list[str] files: KenLM .cc files
+    :param bool verbose:
+    :return: filename -> source code, for :class:`OpCodeCompiler` extra_sources
+    :rtype: dict[str,str]
+    """
+    import hashlib
+    import pickle
+    from returnn.util.basic import get_cache_dir
+
+    h = hashlib.md5()
+    h.update(("v%i:" % _extra_sources_format_version).encode("utf8"))
+    h.update(_kenlm_src_code_workarounds.encode("utf8"))
+    for fn in sorted(files):
+        st = os.stat(fn)
+        h.update(("{%s:%i:%i}" % (fn, st.st_mtime_ns, st.st_size)).encode("utf8"))
+    cache_dir = "%s/returnn_tf_cache/kenlm_src" % get_cache_dir()
+    cache_fn = "%s/%s.pkl" % (cache_dir, h.hexdigest())
+    if os.path.exists(cache_fn):
+        try:
+            with open(cache_fn, "rb") as f:
+                extra_sources = pickle.load(f)
+            assert isinstance(extra_sources, dict)
+            os.utime(cache_fn, None)  # mark as recently used, see _cleanup_extra_sources_cache
+            return extra_sources
+        except Exception as exc:  # e.g. when another proc is just writing it. it's only a cache
+            if verbose:
+                print("KenLM: ignoring source cache %r, exception: %r" % (cache_fn, exc))
+    extra_sources = _make_extra_sources(files)
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp_fn = "%s.%i.tmp" % (cache_fn, os.getpid())
+        with open(tmp_fn, "wb") as f:
+            pickle.dump(extra_sources, f)
+        os.replace(tmp_fn, cache_fn)  # atomic, such that other procs never see a partial file
+        _cleanup_extra_sources_cache(cache_dir, verbose=verbose)
+    except OSError as exc:
+        if verbose:
+            print("KenLM: cannot write source cache %r, exception: %r" % (cache_fn, exc))
+    return extra_sources
+
+
+def _cleanup_extra_sources_cache(cache_dir, verbose=False):
+    """
+    Removes the files in the cache dir of :func:`_get_extra_sources` which were not used for a while,
+    e.g. from other KenLM checkouts or older versions of the KenLM files.
+
+    :param str cache_dir:
+    :param bool verbose:
+    """
+    import time
+    from returnn.util.basic import NativeCodeCompiler
+
+    # noinspection PyProtectedMember
+    cleanup_time_limit_secs = NativeCodeCompiler._cleanup_time_limit_days * 24 * 60 * 60
+    for name in os.listdir(cache_dir):
+        fn = "%s/%s" % (cache_dir, name)
+        try:
+            if time.time() - os.path.getmtime(fn) > cleanup_time_limit_secs:
+                if verbose:
+                    print("KenLM: delete old source cache %r" % fn)
+                os.remove(fn)
+        except OSError:  # e.g. removed concurrently by another proc
+            pass
+
+
 _tf_mod = None
 
 
-def get_tf_mod(verbose=False):
+def get_tf_mod(verbose=False, pgo=False, pgo_lm_filename=None, pgo_corpus_filename=None):
     """
     :param bool verbose:
+    :param bool pgo: use profile-guided optimization (PGO) (GCC).
+        The op is first compiled with instrumentation, then run over the corpus (in a subprocess)
+        to gather the profile data, and then compiled again with this profile data.
+        All the builds, together with the profile data, are cached,
+        i.e. later sessions directly reuse the final build.
+        Note that the module is only loaded once per process, i.e. only the first call decides about this.
+    :param str|None pgo_lm_filename: LM for gathering the profile data. the KenLM test LM by default
+    :param str|None pgo_corpus_filename: text file, one sentence per line, for gathering the profile data.
+        Should be representative for the actual usage.
+        Only needed when there is no profile data yet.
     :return: module
     """
     global _tf_mod
@@ -381,49 +759,60 @@ def get_tf_mod(verbose=False):
     if platform.system() != "Darwin":
         libs.append("rt")
 
-    # Put code all together in one big blob.
-    src_code = ""
-    src_code += _kenlm_src_code_workarounds
-    for fn in files:
-        f_code = open(fn).read()
-        f_code = "".join([x for x in f_code if ord(x) < 128])  # enforce ASCII
-        # We need to do some replacements to not clash symbol names.
-        fn_short = os.path.basename(fn).replace(".", "_")
-        for word in ["kConverter"]:
-            f_code = f_code.replace(word, "%s_%s" % (fn_short, word))
-        src_code += "\n// ------------ %s : BEGIN { ------------\n" % os.path.basename(fn)
-        # https://gcc.gnu.org/onlinedocs/cpp/Line-Control.html#Line-Control
-        src_code += '#line 1 "%s"\n' % os.path.basename(fn)
-        src_code += f_code
-        src_code += "\n// ------------ %s : END } --------------\n\n" % os.path.basename(fn)
-    src_code += "\n\n// ------------ our code now: ------------\n\n"
-    src_code += '#line 1 "<our code>"\n'
-    src_code += _src_code
-
-    compiler = OpCodeCompiler(
-        base_name="KenLM",
-        code_version=1,
-        code=src_code,
-        include_paths=(kenlm_dir, kenlm_dir + "/util/double-conversion"),
-        c_macro_defines={"NDEBUG": 1, "KENLM_MAX_ORDER": 6, "HAVE_ZLIB": 1},
-        ld_flags=["-l%s" % lib for lib in libs],
-        is_cpp=True,
-        use_cuda_if_available=False,
-        verbose=verbose,
-    )
+    extra_sources = _get_extra_sources(files, verbose=verbose)
+
+    def _make_compiler(**kwargs):
+        return OpCodeCompiler(
+            base_name="KenLM",
+            code_version=1,
+            code=_src_code,
+            extra_sources=extra_sources,
+            # The KenLM sources partly include relative to their own dir, which is not the case for our copies.
+            include_paths=(kenlm_dir, kenlm_dir + "/lm", kenlm_dir + "/util", kenlm_dir + "/util/double-conversion"),
+            c_macro_defines={"NDEBUG": 1, "KENLM_MAX_ORDER": 6, "HAVE_ZLIB": 1},
+            ld_flags=["-l%s" % lib for lib in libs],
+            # The probing hash lookup is the hot loop, which benefits from native instructions (popcnt, AVX2, ...).
+            # No -ffast-math, as KenLM relies e.g. on the sign of -0.0 backoffs (kNoExtensionBackoff).
+            extra_compiler_opts=["-O3", "-march=native", "-funroll-loops"],
+            is_cpp=True,
+            use_cuda_if_available=False,
+            verbose=verbose,
+            **kwargs,
+        )
+
+    if pgo:
+        # The hash probes (bucket occupancy) and the backoff depth are data-dependent branches,
+        # where the profile data helps for the block layout and inlining.
+        pgo_compiler = _make_compiler(profile_generate=True)
+        compiler = _make_compiler(profile_use_dir=pgo_compiler.get_lib_dir())
+        if not compiler.is_compiled() and not pgo_compiler.get_profile_data_files():
+            assert pgo_corpus_filename, "KenLM PGO: no profile data yet, need pgo_corpus_filename"
+            _pgo_train(
+                pgo_compiler,
+                lm_filename=pgo_lm_filename or (kenlm_dir + "/lm/test.arpa"),
+                corpus_filename=pgo_corpus_filename,
+                verbose=verbose,
+            )
+    else:
+        compiler = _make_compiler()
     tf_mod = compiler.load_tf_module()
     assert hasattr(tf_mod, "ken_lm_abs_score_strings"), "content of mod: %r" % (dir(tf_mod),)
     _tf_mod = tf_mod
     return tf_mod
 
 
-def ken_lm_load(filename):
+def ken_lm_load(filename, cache_size=0, model_type="probing"):
     """
     :param str filename:
+    :param int cache_size: max num of cached text scores for :func:`ken_lm_abs_score_strings`
+        and :func:`ken_lm_abs_score_bpe_strings`.
+        This helps e.g. in beam search, where the same texts are scored often. 0 disables the cache.
+    :param str model_type: "probing" (default, fastest), "rest_probing" or "trie" (less memory).
+        For a binary model file, this must match the type it was built with (``build_binary <type>``).
     :return: TF resource handle
     :rtype: tf.Tensor
     """
-    return get_tf_mod().ken_lm_load_model(filename=filename)
+    return get_tf_mod().ken_lm_load_model(filename=filename, cache_size=cache_size, model_type=model_type)
 
 
 def ken_lm_abs_score_strings(handle, strings):
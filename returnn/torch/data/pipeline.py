@@ -21,7 +21,6 @@ other PyTorch datasets more directly, including also HuggingFace datasets.
 from __future__ import annotations
 from typing import Union, List, Dict
 import sys
-from copy import deepcopy
 
 import numpy
 import torch
@@ -32,17 +31,30 @@ from returnn.util.basic import NumbersDict
 
 def create_tensor(array: numpy.ndarray) -> Union[torch.Tensor, numpy.ndarray]:
     """
-    Adjust non-supported dtypes
+    Adjust non-supported dtypes.
+    If possible, this does not copy the data, i.e. the resulting tensor shares the memory with the array.
 
     :param array: numpy array to be converted
     """
-    # The only supported PyTorch dtypes are:
-    # float64, float32, float16, complex64, complex128, int64, int32, int16, int8, uint8, and bool.
     if array.dtype.kind in "UO":  # string (unicode) or object
         return array  # keep as-is. e.g. seq_tag
-    if array.dtype == numpy.uint32:
-        array = numpy.asarray(array, dtype=numpy.int64)
-    return torch.tensor(array)
+    # No-op if the array is already C-contiguous with a supported dtype. Keeps 0-d arrays as-is.
+    array = numpy.asarray(array, dtype=_get_torch_supported_numpy_dtype(array.dtype), order="C")
+    if not array.flags.writeable:
+        return torch.tensor(array)  # torch.from_numpy does not support read-only memory
+    return torch.from_numpy(array)
+
+
+def _get_torch_supported_numpy_dtype(dtype: numpy.dtype) -> numpy.dtype:
+    """
+    :param dtype: numpy dtype, not string or object
+    :return: dtype which can be converted to PyTorch
+    """
+    # The only supported PyTorch dtypes are:
+    # float64, float32, float16, complex64, complex128, int64, int32, int16, int8, uint8, and bool.
+    if dtype == numpy.uint32:
+        return numpy.dtype(numpy.int64)
+    return dtype
 
 
 def collate_batch(batch: List[Dict[str, numpy.ndarray]]) -> Dict[str, Union[torch.Tensor, numpy.ndarray]]:
@@ -56,19 +68,26 @@ def collate_batch(batch: List[Dict[str, numpy.ndarray]]) -> Dict[str, Union[torc
 
     res = {}
     for key in data_keys:
-        ls = [create_tensor(sample[key]) for sample in batch]
-        if not ls:
-            raise ValueError("batch is empty?")
-        if isinstance(ls[0], torch.Tensor):
-            if ls[0].ndim > 0:
-                padded = torch.nn.utils.rnn.pad_sequence(ls, batch_first=True, padding_value=0)
-                res[key] = padded
-                res["%s:seq_len" % key] = torch.tensor([v.shape[0] for v in ls], dtype=torch.int32)
+        ls = [sample[key] for sample in batch]
+        if ls[0].dtype.kind in "UO":  # string (unicode) or object, e.g. seq_tag. keep as numpy
+            res[key] = numpy.stack(ls, axis=0)
+        elif ls[0].ndim > 0:
+            # Allocate the padded array only once and copy each sequence directly into it.
+            seq_lens = numpy.array([v.shape[0] for v in ls], dtype=numpy.int32)
+            max_seq_len = int(seq_lens.max())
+            shape = (len(ls), max_seq_len) + ls[0].shape[1:]
+            dtype = _get_torch_supported_numpy_dtype(ls[0].dtype)
+            if (seq_lens == max_seq_len).all():
+                padded = numpy.empty(shape, dtype=dtype)  # no padding needed
             else:
-                res[key] = torch.stack(ls, dim=0)
-        elif isinstance(ls[0], numpy.ndarray):
-            padded = numpy.stack(ls, axis=0)
-            res[key] = padded
+                padded = numpy.zeros(shape, dtype=dtype)
+            for i, v in enumerate(ls):
+                assert v.shape[1:] == ls[0].shape[1:], f"collate_batch: {key!r} shape mismatch, {v.shape} vs {shape}"
+                padded[i, : v.shape[0]] = v
+            res[key] = torch.from_numpy(padded)
+            res["%s:seq_len" % key] = torch.from_numpy(seq_lens)
+        else:
+            res[key] = create_tensor(numpy.stack(ls, axis=0))
 
     return res
 
@@ -102,37 +121,35 @@ class ChunkingIterDataPipe(torch.utils.data.IterDataPipe):
 
         assert not custom_chunk_func, f"Custom chunking function not supported, {chunking!r}"
 
+        # Precomputed, to avoid the NumbersDict lookups for every sequence.
+        # If the data keys are not configured explicitly, this is determined by the first sequence.
+        self._chunking_schedule = (
+            self._make_chunking_schedule(list(self._chunk_size.keys())) if self._chunk_size.keys() else None
+        )
+
     def __iter__(self):
         """
         :return: generator providing chunks in the form of a dict data_key -> data chunk
         :rtype: Iterable[dict[str, numpy.ndarray]]
         """
-        chunking_data_keys = list(self._chunk_size.keys())
+        chunking_schedule = self._chunking_schedule
 
         for data_dict in self._dataset:
 
-            if not chunking_data_keys:
+            if chunking_schedule is None:
                 chunking_data_keys = list(data_dict.keys())  # use all if not configured separately
                 chunking_data_key_black_list = ["seq_tag"]
                 for key in chunking_data_key_black_list:
                     if key in chunking_data_keys:
                         chunking_data_keys.remove(key)
                 assert chunking_data_keys, "Dataset produced sequence without any data."
+                chunking_schedule = self._make_chunking_schedule(chunking_data_keys)
 
             data_chunks = {}
             num_chunks = None
 
-            for data_key in chunking_data_keys:
-                chunk_size = self._chunk_size[data_key]
-                chunk_step = self._chunk_step[data_key]
-                min_chunk_size = self._min_chunk_size[data_key]
-
-                data = data_dict[data_key]
-                chunks = [
-                    data[start_index : start_index + chunk_size]
-                    for start_index in range(0, len(data), chunk_step)
-                    if len(data[start_index : start_index + chunk_size]) >= min_chunk_size
-                ]
+            for data_key, chunk_size, chunk_step, min_chunk_size in chunking_schedule:
+                chunks = self._make_chunks(data_dict[data_key], chunk_size, chunk_step, min_chunk_size)
 
                 if num_chunks is None:
                     num_chunks = len(chunks)
@@ -146,23 +163,71 @@ class ChunkingIterDataPipe(torch.utils.data.IterDataPipe):
             if num_chunks == 0:
                 continue
             assert num_chunks, "Bug: no chunk produced from current sequence."
+
+            # If chunking is configured using a dict,
+            # i.e. with explicit data keys, there might be remaining data keys
+            # for which we yield the full sequence in each chunk.
+            # This is shared over the chunks without copying, as we never modify the data inplace
+            # (e.g. collate_batch copies it into a new padded array).
+            non_chunked_data = {data_key: data for data_key, data in data_dict.items() if data_key not in data_chunks}
+
             for chunk_index in range(num_chunks):
                 chunk_data = {data_key: data_chunks[data_key][chunk_index] for data_key in data_chunks.keys()}
-
-                # If chunking is configured using a dict,
-                # i.e. with explicit data keys, there might be remaining data keys
-                # for which we yield the full sequence in each chunk.
-                non_chunked_data = {
-                    data_key: data for data_key, data in data_dict.items() if data_key not in chunk_data
-                }
-                if non_chunked_data:
-                    chunk_data.update(deepcopy(non_chunked_data))
+                chunk_data.update(non_chunked_data)
 
                 yield chunk_data
 
     def __getitem__(self, index):
         raise Exception(f"{self.__class__.__name__}.__getitem__ not supported")
 
+    def _make_chunking_schedule(self, chunking_data_keys):
+        """
+        :param list[str] chunking_data_keys:
+        :return: (data_key, chunk_size, chunk_step, min_chunk_size) for each data key
+        :rtype: tuple[(str,int,int,int)]
+        """
+        return tuple(
+            (data_key, self._chunk_size[data_key], self._chunk_step[data_key], self._min_chunk_size[data_key])
+            for data_key in chunking_data_keys
+        )
+
+    @staticmethod
+    def _make_chunks(data, chunk_size: int, chunk_step: int, min_chunk_size: int):
+        """
+        Same as ``[data[i : i + chunk_size] for i in range(0, len(data), chunk_step)]``,
+        filtered by ``min_chunk_size``,
+        but all the full chunks are created as a single strided view (no copy) for numpy arrays.
+
+        :param numpy.ndarray|typing.Sequence data:
+        :return: list of chunks
+        :rtype: list[numpy.ndarray]|list[typing.Sequence]
+        """
+        if chunk_size < min_chunk_size:
+            return []  # any chunk would be too short
+        seq_len = len(data)
+        num_full_chunks = (seq_len - chunk_size) // chunk_step + 1 if seq_len >= chunk_size else 0
+        if isinstance(data, numpy.ndarray) and num_full_chunks > 0:
+            if chunk_step == chunk_size:
+                full_chunks = data[: num_full_chunks * chunk_size].reshape(
+                    (num_full_chunks, chunk_size) + data.shape[1:]
+                )
+            else:
+                full_chunks = numpy.lib.stride_tricks.as_strided(
+                    data,
+                    shape=(num_full_chunks, chunk_size) + data.shape[1:],
+                    strides=(data.strides[0] * chunk_step,) + data.strides,
+                    # Chunks might overlap, thus writing would be unexpected.
+                    writeable=chunk_step > chunk_size,
+                )
+            chunks = list(full_chunks)
+        else:
+            chunks = [data[i * chunk_step : i * chunk_step + chunk_size] for i in range(num_full_chunks)]
+        # The remaining chunks are shorter than chunk_size.
+        for start_index in range(num_full_chunks * chunk_step, seq_len, chunk_step):
+            if seq_len - start_index >= min_chunk_size:
+                chunks.append(data[start_index:])
+        return chunks
+
     @staticmethod
     def _parse_chunking(chunking):
         """
@@ -196,10 +261,12 @@ class BatchingIterDataPipe(torch.utils.data.IterDataPipe):
     these sequences, i.e. batches.
     Sequences are grouped in-order according to the 'max_tokens' and 'max_seqs' batch size
     limits.
-    Note, that batches are not yet merged into a single (padded) data array here, this happens in 'collate_batch()'.
+    Note, that by default, batches are not yet merged into a single (padded) data array here,
+    this happens in 'collate_batch()'.
+    With collate=True, this directly yields the padded batches, without a separate collator datapipe.
     """
 
-    def __init__(self, dataset: torch.utils.data.IterableDataset, batch_size=1, max_seqs=None):
+    def __init__(self, dataset: torch.utils.data.IterableDataset, batch_size=1, max_seqs=None, *, collate=False):
         """
         :param dataset: dataset to apply batching to
         :param int|dict[str,int]|None batch_size: Maximum number of time steps (e.g. audio frames / words) in one
@@ -208,45 +275,75 @@ class BatchingIterDataPipe(torch.utils.data.IterDataPipe):
             If None, no limit.
         :param int|None max_seqs: maximum number of sequences in a batch,
             None means unlimited (also -1 to match TF backend)
+        :param bool collate: if True, apply :func:`collate_batch` on each batch,
+            i.e. yield dict data_key -> padded tensor instead of the list of sequences.
         """
         super().__init__()
         self._dataset = dataset
-        self._max_batch_size = NumbersDict(sys.maxsize if batch_size is None else batch_size)
+        max_batch_size = NumbersDict(sys.maxsize if batch_size is None else batch_size)
+        # Plain dict data_key -> limit, and the limit for other data keys (or None),
+        # as we need this for every sequence, and NumbersDict lookups are slower.
+        self._max_batch_size = dict(max_batch_size.dict)
+        self._max_batch_size_default = max_batch_size.value
         self._max_seqs = sys.maxsize if (max_seqs is None or max_seqs == -1) else max_seqs
+        self._collate = collate
 
-        assert self._max_batch_size.min_value() > 0
+        assert max_batch_size.min_value() > 0
         assert self._max_seqs > 0
 
     def __iter__(self):
         """
         :return: generator providing batches in the form of lists of sequences, where each sequence is a dict
-          data_key -> data_array.
+          data_key -> data_array, or with collate=True, the padded batches, see :func:`collate_batch`.
+        :rtype: Iterable[list[dict[str, numpy.ndarray]]]|Iterable[dict[str, torch.Tensor|numpy.ndarray]]
+        """
+        for batch in self._iter_batches():
+            yield collate_batch(batch) if self._collate else batch
+
+    def _iter_batches(self):
+        """
+        :return: generator providing batches in the form of lists of sequences
         :rtype: Iterable[list[dict[str, numpy.ndarray]]]
         """
+        max_batch_size = self._max_batch_size
+        max_batch_size_default = self._max_batch_size_default
+        max_seqs = self._max_seqs
+
         current_batch = []
-        current_max_sequence_lengths = NumbersDict(0)  # data_key -> length of longest sequence in current batch
+        current_max_sequence_lengths = {}  # data_key -> length of longest sequence in current batch
 
         for data_dict in self._dataset:
-            if len(current_batch) == self._max_seqs:
+            if len(current_batch) == max_seqs:
                 yield current_batch
                 current_batch = []
-                current_max_sequence_lengths = NumbersDict(0)
+                current_max_sequence_lengths = {}
 
             # TODO: This assumes all data has time as first dimension. Currently we can't know better..
-            sequence_lengths = NumbersDict(
-                {data_key: data.shape[0] for data_key, data in data_dict.items() if data.shape}
-            )
-
-            max_sequence_lengths_if_included = NumbersDict.max([current_max_sequence_lengths, sequence_lengths])
-            batch_size_if_included = max_sequence_lengths_if_included * (len(current_batch) + 1)  # including padding
-
-            if current_batch and batch_size_if_included.any_compare(self._max_batch_size, (lambda a, b: a > b)):
+            sequence_lengths = {data_key: data.shape[0] for data_key, data in data_dict.items() if data.shape}
+
+            exceeds_max_batch_size = False
+            if current_batch:
+                num_seqs_if_included = len(current_batch) + 1
+                for data_key in current_max_sequence_lengths.keys() | sequence_lengths.keys():
+                    limit = max_batch_size.get(data_key, max_batch_size_default)
+                    if limit is None:
+                        continue
+                    max_sequence_length_if_included = max(
+                        current_max_sequence_lengths.get(data_key, 0), sequence_lengths.get(data_key, 0)
+                    )
+                    if max_sequence_length_if_included * num_seqs_if_included > limit:  # including padding
+                        exceeds_max_batch_size = True
+                        break
+
+            if exceeds_max_batch_size:
                 yield current_batch
                 current_batch = [data_dict]
                 current_max_sequence_lengths = sequence_lengths
             else:
                 current_batch.append(data_dict)
-                current_max_sequence_lengths = max_sequence_lengths_if_included
+                for data_key, sequence_length in sequence_lengths.items():
+                    if sequence_length > current_max_sequence_lengths.get(data_key, 0):
+                        current_max_sequence_lengths[data_key] = sequence_length
 
         if current_batch:
             yield current_batch
@@ -70,17 +70,29 @@ class ReturnnDatasetIterDataPipe(torch.utils.data.IterDataPipe):
 
     def __iter__(self) -> Iterable[Dict[str, numpy.ndarray]]:
         """
+        When used in a worker process of a PyTorch DataLoader (``num_workers > 0``),
+        this respects :func:`torch.utils.data.get_worker_info`,
+        i.e. each worker only yields its share of the sequences (every ``num_workers``-th sequence),
+        such that the sequences are not duplicated over the workers.
+        Then the further pipeline (chunking, batching, collating) also runs in the worker processes,
+        e.g. via ``DataLoader(..., num_workers=N, prefetch_factor=4, persistent_workers=True)``.
+        We cannot partition into contiguous ranges, as the number of sequences is not always known in advance.
+
         :return: generator providing data samples in the form of a dict data_key -> data
         """
         data_keys = self._dataset.get_data_keys()
 
-        seq_index = 0
+        worker_info = torch.utils.data.get_worker_info()
+        if worker_info is not None:
+            seq_index, seq_index_step = worker_info.id, worker_info.num_workers
+        else:
+            seq_index, seq_index_step = 0, 1
         while self._dataset.is_less_than_num_seqs(seq_index):
             self._dataset.load_seqs(seq_index, seq_index + 1)
             data = {data_key: self._dataset.get_data(seq_index, data_key) for data_key in data_keys}
             data["seq_tag"] = str_to_numpy_array(self._dataset.get_tag(seq_index))
             yield data
-            seq_index += 1
+            seq_index += seq_index_step
 
     def __getitem__(self, index):
         raise Exception(f"{self.__class__.__name__}.__getitem__ not supported")
@@ -13,7 +13,6 @@ import torch
 import time
 from torch.distributed import init_process_group
 from torch.nn.parallel import DistributedDataParallel
-import torch.utils.data.datapipes as dp
 from torch import autocast
 from torch.cuda import amp
 from torchdata.dataloader2 import DataLoader2
@@ -441,8 +440,9 @@ class Engine(EngineBase):
         assert self.config.typed_value("batch_size") is not None, "batch_size not defined in config"
         batch_size = self.config.typed_value("batch_size", 1)
         max_seqs = self.config.int("max_seqs", -1)
-        batches_dataset = data_pipeline.BatchingIterDataPipe(wrapped_dataset, batch_size=batch_size, max_seqs=max_seqs)
-        batches_dataset = dp.iter.Collator(batches_dataset, collate_fn=data_pipeline.collate_batch)
+        batches_dataset = data_pipeline.BatchingIterDataPipe(
+            wrapped_dataset, batch_size=batch_size, max_seqs=max_seqs, collate=True
+        )
 
         try:
             return DataLoader2(batches_dataset)
@@ -3332,6 +3332,26 @@ def _get_num_gpu_devices():
         return num_cpus, num_gpus
 
 
+def get_cpu_model_name():
+    """
+    :return: e.g. "Intel(R) Xeon(R) CPU E5-2620 v4 @ 2.10GHz", or some fallback if not possible to determine
+    :rtype: str
+    """
+    if sys.platform == "darwin":
+        try:
+            return sys_cmd_out_lines("sysctl -n machdep.cpu.brand_string")[0]
+        except (CalledProcessError, IndexError):
+            pass
+    elif os.path.exists("/proc/cpuinfo"):
+        with open("/proc/cpuinfo") as f:
+            for line in f:
+                if line.startswith("model name") and ":" in line:
+                    return line.split(":", 1)[1].strip()
+    import platform
+
+    return platform.processor() or platform.machine()
+
+
 _num_devices = None
 
 
@@ -3598,10 +3618,14 @@ class NativeCodeCompiler(object):
         ld_flags=None,
         include_paths=(),
         include_deps=None,
+        extra_sources=None,
+        extra_compiler_opts=None,
         static_version_name=None,
         should_cleanup_old_all=True,
         should_cleanup_old_mydir=False,
         use_cxx11_abi=False,
+        profile_generate=False,
+        profile_use_dir=None,
         log_stream=None,
         verbose=False,
     ):
@@ -3616,12 +3640,23 @@ class NativeCodeCompiler(object):
         :param list[str]|None include_deps: if provided and an existing lib file,
             we will check if any dependency is newer
             and we need to recompile. we could also do it automatically via -MD but that seems overkill and too slow.
+        :param dict[str,str]|None extra_sources: filename -> source code.
+            Each is compiled as a separate translation unit (in parallel) and linked together with `code`.
+            This is useful for big code bases, where one big translation unit would be slow to compile.
+        :param list[str]|None extra_compiler_opts: e.g. ["-O3", "-march=native"].
+            These come after the default opts, thus can override e.g. the default -O2.
         :param str|None static_version_name: normally, we use .../base_name/hash as the dir
             but this would use .../base_name/static_version_name.
         :param bool should_cleanup_old_all: whether we should look in the cache dir
             and check all ops if we can delete some old ones which are older than some limit
             (self._cleanup_time_limit_days)
         :param bool should_cleanup_old_mydir: whether we should delete our op dir before we compile there.
+        :param bool profile_generate: first pass of profile-guided optimization (PGO) (GCC).
+            Instruments the code, such that any process which runs it writes the profile data
+            (.gcda files next to the object files, i.e. in our dir, see :func:`get_profile_data_files`) at exit.
+        :param str|None profile_use_dir: second pass of PGO. Dir with the .gcda files from the first pass,
+            where the compiler must have been the same except of `profile_generate`.
+            The files are copied to our dir before compiling.
         :param typing.TextIO|None log_stream: file stream for print statements
         :param bool verbose: be slightly more verbose
         """
@@ -3633,10 +3668,21 @@ class NativeCodeCompiler(object):
         self.base_name = base_name
         self.code_version = code_version
         self.code = code
+        self.extra_sources = extra_sources
         self.is_cpp = is_cpp
         self.c_macro_defines = {k: v for k, v in (c_macro_defines or {}).items() if v is not None}
         self.ld_flags = ld_flags or []
         self.include_deps = include_deps
+        self.extra_compiler_opts = list(extra_compiler_opts or [])
+        self.profile_generate = profile_generate
+        self.profile_use_dir = profile_use_dir
+        if profile_generate:
+            assert not profile_use_dir, "%s: profile_generate excludes profile_use_dir" % self.__class__.__name__
+            self.extra_compiler_opts += ["-fprofile-generate"]
+            self.ld_flags = self.ld_flags + ["-fprofile-generate"]  # links libgcov
+        if profile_use_dir:
+            # -fprofile-correction: the profile counters are not thread-safe, thus can be inconsistent.
+            self.extra_compiler_opts += ["-fprofile-use", "-fprofile-correction"]
         self.static_version_name = static_version_name
         self._code_hash = self._make_code_hash()
         self._info_dict = self._make_info_dict()
@@ -3726,7 +3772,14 @@ class NativeCodeCompiler(object):
         assert isinstance(res, dict)
         return res
 
-    _relevant_info_keys = ("code_version", "code_hash", "c_macro_defines", "ld_flags", "compiler_bin")
+    _relevant_info_keys = (
+        "code_version",
+        "code_hash",
+        "c_macro_defines",
+        "ld_flags",
+        "extra_compiler_opts",
+        "compiler_bin",
+    )
 
     def _make_info_dict(self):
         """
@@ -3739,14 +3792,33 @@ class NativeCodeCompiler(object):
             "code_hash": self._code_hash,
             "c_macro_defines": self.c_macro_defines,
             "ld_flags": self.ld_flags,
+            "extra_compiler_opts": self._extra_compiler_opts_info(),
             "compiler_bin": self._get_compiler_bin(),
         }
 
+    def _extra_compiler_opts_info(self):
+        """
+        :return: extra_compiler_opts as it goes into the info dict (and thus the hash).
+            Host-specific opts like -march=native are annotated by the host CPU,
+            such that a shared cache dir (e.g. home dir on a cluster) does not mix up libs for different CPUs.
+        :rtype: list[str]
+        """
+        res = []
+        for opt in self.extra_compiler_opts:
+            if opt in ("-march=native", "-mtune=native", "-mcpu=native"):
+                opt = "%s(%s)" % (opt, get_cpu_model_name())
+            res.append(opt)
+        return res
+
     def _make_code_hash(self):
         import hashlib
 
         h = hashlib.md5()
         h.update(self.code.encode("utf8"))
+        for name, code in sorted((self.extra_sources or {}).items()):
+            h.update(("{%s:" % name).encode("utf8"))
+            h.update(code.encode("utf8"))
+            h.update("}".encode("utf8"))
         return h.hexdigest()
 
     def _make_hash(self):
@@ -3790,6 +3862,23 @@ class NativeCodeCompiler(object):
         # But I think this is overkill.
         return False
 
+    def is_compiled(self):
+        """
+        :return: whether the lib exists and is up-to-date, i.e. no (re)compilation is needed
+        :rtype: bool
+        """
+        return not self._need_recompile()
+
+    def get_profile_data_files(self):
+        """
+        :return: the PGO profile data files (.gcda) in our dir, written by processes which ran the lib
+            compiled with `profile_generate`
+        :rtype: list[str]
+        """
+        from glob import glob
+
+        return sorted(glob("%s/*.gcda" % self._mod_path))
+
     def _maybe_compile(self):
         """
         On successful return, self._so_filename should exist and be up-to-date.
@@ -3854,23 +3943,74 @@ class NativeCodeCompiler(object):
         assert os.path.exists(self._mod_path)
         with open(self._c_filename, "w") as f:
             f.write(self.code)
-        common_opts = ["-shared", "-O2"]
-        common_opts += self._extra_common_opts()
-        if sys.platform == "darwin":
-            common_opts += ["-undefined", "dynamic_lookup"]
+        if self.profile_use_dir:
+            import shutil
+            from glob import glob
+
+            profile_files = glob("%s/*.gcda" % self.profile_use_dir)
+            assert profile_files, "%s: no profile data in %r" % (self.__class__.__name__, self.profile_use_dir)
+            for fn in profile_files:
+                shutil.copy(fn, self._mod_path)
+        compile_opts = ["-O2"]
+        compile_opts += self._extra_common_opts()
         for include_path in self._include_paths:
-            common_opts += ["-I", include_path]
-        compiler_opts = ["-fPIC", "-v"]
-        common_opts += self._transform_compiler_opts(compiler_opts)
-        common_opts += ["-D_GLIBCXX_USE_CXX11_ABI=%i" % (1 if self.use_cxx11_abi else 0)]
-        common_opts += ["-D%s=%s" % item for item in sorted(self.c_macro_defines.items())]
-        common_opts += ["-g"]
-        opts = common_opts + [self._c_filename, "-o", self._so_filename]
-        opts += list(map(self._transform_ld_flag, self.ld_flags))
+            compile_opts += ["-I", include_path]
+        compiler_opts = ["-fPIC", "-v"] + self.extra_compiler_opts
+        compile_opts += self._transform_compiler_opts(compiler_opts)
+        compile_opts += ["-D_GLIBCXX_USE_CXX11_ABI=%i" % (1 if self.use_cxx11_abi else 0)]
+        compile_opts += ["-D%s=%s" % item for item in sorted(self.c_macro_defines.items())]
+        compile_opts += ["-g"]
+        link_opts = ["-shared"]
+        if sys.platform == "darwin":
+            link_opts += ["-undefined", "dynamic_lookup"]
+        ld_flags = list(map(self._transform_ld_flag, self.ld_flags))
         cmd_bin = self._get_compiler_bin()
-        cmd_args = [cmd_bin] + opts
+        if self.extra_sources or self.profile_generate or self.profile_use_dir:
+            # Compile each source file separately (in parallel), and then link them all together.
+            # With PGO, this also gives us well-defined profile data filenames (object filename with .gcda).
+            src_filenames = [self._c_filename]
+            for name, code in sorted((self.extra_sources or {}).items()):
+                src_filename = "%s/%s" % (self._mod_path, name)
+                assert src_filename != self._c_filename, "%s: extra source %r clashes with main code" % (self, name)
+                with open(src_filename, "w") as f:
+                    f.write(code)
+                src_filenames.append(src_filename)
+            obj_filenames = [os.path.splitext(fn)[0] + ".o" for fn in src_filenames]
+            # The compiler runs in our dir. Relative filenames keep the source locations independent of our dir,
+            # which PGO requires, as the profile data of another dir (profile_use_dir) is checked against them.
+            compile_cmds = [
+                [cmd_bin] + compile_opts + ["-c", os.path.basename(src_filename), "-o", os.path.basename(obj_filename)]
+                for src_filename, obj_filename in zip(src_filenames, obj_filenames)
+            ]
+            from concurrent.futures import ThreadPoolExecutor
+
+            with ThreadPoolExecutor(max_workers=min(len(compile_cmds), os.cpu_count() or 1)) as executor:
+                outputs = list(executor.map(self._run_compiler, compile_cmds))
+            link_cmd = [cmd_bin] + link_opts + obj_filenames + ["-o", self._so_filename] + ld_flags
+            outputs.append(self._run_compiler(link_cmd))
+        else:
+            # Compile and link in one go.
+            cmd_args = [cmd_bin] + link_opts + compile_opts + [self._c_filename, "-o", self._so_filename] + ld_flags
+            outputs = [self._run_compiler(cmd_args)]
+        assert os.path.exists(self._so_filename)
+        with open("%s/compile.log" % self._mod_path, "wb") as f:
+            if self.verbose:
+                print("%s: write compile log to: %s" % (self.__class__.__name__, f.name))
+            for cmd_args, stdout in outputs:
+                f.write(("+ %s\n" % " ".join(cmd_args)).encode("utf8"))
+                f.write(stdout)
+        self._save_info()
+        assert not self._need_recompile()
+
+    def _run_compiler(self, cmd_args):
+        """
+        :param list[str] cmd_args: compiler binary and its args
+        :return: cmd_args, stdout (including stderr)
+        :rtype: (list[str], bytes)
+        """
         from subprocess import Popen, PIPE, STDOUT, CalledProcessError
 
+        cmd_bin = cmd_args[0]
         print("%s call: %s" % (self.__class__.__name__, " ".join(cmd_args)), file=self._log_stream)
         proc = Popen(cmd_args, cwd=self._mod_path, stdout=PIPE, stderr=STDOUT)
         stdout, stderr = proc.communicate()
@@ -3887,14 +4027,7 @@ class NativeCodeCompiler(object):
                 print("Your GCC version might be too new. This is a problem with some nvcc versions.")
                 print()
             raise CalledProcessError(returncode=proc.returncode, cmd=cmd_args)
-        assert os.path.exists(self._so_filename)
-        with open("%s/compile.log" % self._mod_path, "wb") as f:
-            if self.verbose:
-                print("%s: write compile log to: %s" % (self.__class__.__name__, f.name))
-            f.write(("+ %s\n" % " ".join(cmd_args)).encode("utf8"))
-            f.write(stdout)
-        self._save_info()
-        assert not self._need_recompile()
+        return cmd_args, stdout
 
     def load_lib_ctypes(self):
         """
@@ -3915,6 +4048,13 @@ class NativeCodeCompiler(object):
         self._maybe_compile()
         return self._so_filename
 
+    def get_lib_dir(self):
+        """
+        :return: the dir where the lib is (or will be) compiled. this does not compile.
+        :rtype: str
+        """
+        return self._mod_path
+
 
 # See :func:`maybe_restart_returnn_with_atfork_patch` below for why you might want to use this.
 _c_code_patch_atfork = """
@@ -3294,6 +3294,70 @@ def test_kenlm():
     print("Score is as expected.")
 
 
+def test_kenlm_cache():
+    import returnn.tf.util.ken_lm as tf_ken_lm
+
+    if not tf_ken_lm.kenlm_checked_out():
+        raise unittest.SkipTest("KenLM not checked out")
+    input_strings = ["beyond immediate concerns </s>", "beyond immediate", "concerns </s>"]
+    test_lm_file = tf_ken_lm.kenlm_dir + "/lm/test.arpa"
+    assert os.path.exists(test_lm_file)
+    lm_tf = tf_ken_lm.ken_lm_load(filename=test_lm_file)
+    lm_cached_tf = tf_ken_lm.ken_lm_load(filename=test_lm_file, cache_size=2)
+    input_strings_tf = tf_compat.v1.placeholder(tf.string, [None])
+    output_scores_tf = tf_ken_lm.ken_lm_abs_score_strings(handle=lm_tf, strings=input_strings_tf)
+    output_cached_scores_tf = tf_ken_lm.ken_lm_abs_score_strings(handle=lm_cached_tf, strings=input_strings_tf)
+    with tf_compat.v1.Session() as session:
+        output_scores = session.run(output_scores_tf, feed_dict={input_strings_tf: input_strings})
+        for _ in range(3):  # cache_size 2 < 3 strings, so this covers cache hits and the cache getting full
+            output_cached_scores = session.run(output_cached_scores_tf, feed_dict={input_strings_tf: input_strings})
+            print("output scores:", output_scores, "cached:", output_cached_scores)
+            assert_equal(output_scores.tolist(), output_cached_scores.tolist())
+    assert_almost_equal(output_scores[0], -9.251298)
+
+
+def test_kenlm_cache_size_shared_name_mismatch():
+    import returnn.tf.util.ken_lm as tf_ken_lm
+
+    if not tf_ken_lm.kenlm_checked_out():
+        raise unittest.SkipTest("KenLM not checked out")
+    test_lm_file = tf_ken_lm.kenlm_dir + "/lm/test.arpa"
+    assert os.path.exists(test_lm_file)
+    tf_mod = tf_ken_lm.get_tf_mod()
+    lm_tf = tf_mod.ken_lm_load_model(filename=test_lm_file, shared_name="kenlm_shared")
+    lm_cached_tf = tf_mod.ken_lm_load_model(filename=test_lm_file, cache_size=2, shared_name="kenlm_shared")
+    with tf_compat.v1.Session() as session:
+        session.run(lm_tf)
+        try:
+            session.run(lm_cached_tf)
+        except tf.errors.InvalidArgumentError as exc:
+            print("Got expected TF exception:", exc.message)
+            assert "Cache size mismatch" in exc.message
+        else:
+            assert False, "we should have gotten a TF exception"
+
+
+def test_kenlm_model_type():
+    import returnn.tf.util.ken_lm as tf_ken_lm
+
+    if not tf_ken_lm.kenlm_checked_out():
+        raise unittest.SkipTest("KenLM not checked out")
+    input_strings = ["beyond immediate concerns </s>", "looking beyond the immediate", ""]
+    test_lm_file = tf_ken_lm.kenlm_dir + "/lm/test.arpa"
+    assert os.path.exists(test_lm_file)
+    input_strings_tf = tf_compat.v1.placeholder(tf.string, [None])
+    output_scores_tf = {}
+    for model_type in ["probing", "rest_probing", "trie"]:
+        lm_tf = tf_ken_lm.ken_lm_load(filename=test_lm_file, model_type=model_type)
+        output_scores_tf[model_type] = tf_ken_lm.ken_lm_abs_score_strings(handle=lm_tf, strings=input_strings_tf)
+    with tf_compat.v1.Session() as session:
+        output_scores = session.run(output_scores_tf, feed_dict={input_strings_tf: input_strings})
+    print("output scores:", output_scores)
+    assert_almost_equal(output_scores["probing"][0], -9.251298)
+    for model_type in ["rest_probing", "trie"]:
+        assert_almost_equal(output_scores[model_type], output_scores["probing"], decimal=5)
+
+
 def test_kenlm_bpe():
     import returnn.tf.util.ken_lm as tf_ken_lm
 
@@ -3324,6 +3388,39 @@ def test_kenlm_bpe():
     print("Scores are as expected.")
 
 
+def test_kenlm_bpe_merge():
+    import returnn.tf.util.ken_lm as tf_ken_lm
+
+    if not tf_ken_lm.kenlm_checked_out():
+        raise unittest.SkipTest("KenLM not checked out")
+    input_strings = [
+        "be@@ yond imm@@ edi@@ ate conc@@ erns </s>",
+        "be@@ yond imm@@ ",
+        "  be@@ yond  imm@@  edi@@ ate conc@@@@ erns  ",
+        "\tbe@@ yond @@ immediate\t \n",
+        "@@ beyond immediate@@",
+        "",
+        " ",
+    ]
+    # Reference: merge via plain string replace and strip, then score.
+    ref_strings = [s.replace("@@ ", "").strip() for s in input_strings]
+    test_lm_file = tf_ken_lm.kenlm_dir + "/lm/test.arpa"
+    assert os.path.exists(test_lm_file)
+    lm_tf = tf_ken_lm.ken_lm_load(filename=test_lm_file)
+    input_strings_tf = tf_compat.v1.placeholder(tf.string, [None])
+    output_scores_tf = tf_ken_lm.ken_lm_abs_score_bpe_strings(
+        handle=lm_tf, strings=input_strings_tf, bpe_merge_symbol="@@"
+    )
+    ref_scores_tf = tf_ken_lm.ken_lm_abs_score_strings(handle=lm_tf, strings=input_strings_tf)
+    with tf_compat.v1.Session() as session:
+        output_scores = session.run(output_scores_tf, feed_dict={input_strings_tf: input_strings})
+        ref_scores = session.run(ref_scores_tf, feed_dict={input_strings_tf: ref_strings})
+    print("input strings:", input_strings)
+    print("output scores:", output_scores)
+    print("ref scores:", ref_scores)
+    assert_equal(output_scores.tolist(), ref_scores.tolist())
+
+
 def test_openfst():
     import returnn.tf.util.open_fst as tf_open_fst
 
@@ -188,6 +188,70 @@ def test_NativeCodeCompiler():
     assert_equal(lib.get_magic(), 42)
 
 
+def test_NativeCodeCompiler_extra_sources():
+    native = NativeCodeCompiler(
+        base_name="test_NativeCodeCompiler_extra_sources",
+        code_version=1,
+        code="""
+    int get_magic_impl();
+
+    extern "C" int get_magic() { return get_magic_impl() + 1; }
+    """,
+        extra_sources={
+            "magic.cc": """
+    // Same name as in the other translation unit, which must not clash.
+    static int magic = 13;
+
+    int get_magic_impl() { return magic; }
+    """,
+            "other.cc": """
+    static int magic = 42;
+
+    int get_other_magic_impl() { return magic; }
+    """,
+        },
+    )
+    import ctypes
+
+    lib = native.load_lib_ctypes()
+    lib.get_magic.restype = ctypes.c_int
+    lib.get_magic.argtypes = ()
+
+    assert_equal(lib.get_magic(), 14)
+
+
+def test_NativeCodeCompiler_pgo():
+    import subprocess
+
+    code = """
+    extern "C" int count_odd(int n) {
+      int c = 0;
+      for(int i = 0; i < n; ++i)
+        if(i % 3 != 0) ++c;
+      return c;
+    }
+    """
+    opts = dict(code_version=1, code=code, should_cleanup_old_all=False)
+    native_gen = NativeCodeCompiler(base_name="test_NativeCodeCompiler_pgo", profile_generate=True, **opts)
+    # The profile data is written at process exit.
+    subprocess.check_call(
+        [sys.executable, "-c", "import ctypes, sys; ctypes.CDLL(sys.argv[1]).count_odd(1000)"]
+        + [native_gen.get_lib_filename()]
+    )
+    assert native_gen.get_profile_data_files()
+    native = NativeCodeCompiler(
+        base_name="test_NativeCodeCompiler_pgo", profile_use_dir=native_gen.get_lib_dir(), **opts
+    )
+    assert native.get_lib_dir() != native_gen.get_lib_dir()
+    import ctypes
+
+    lib = native.load_lib_ctypes()
+    lib.count_odd.restype = ctypes.c_int
+    lib.count_odd.argtypes = (ctypes.c_int,)
+    assert_equal(lib.count_odd(9), 6)
+    assert native.is_compiled()
+
+
 def test_Stats():
     rnd = numpy.random.RandomState(42)
     m = rnd.uniform(-2.0, 10.0, (1000, 3))
@@ -65,6 +65,147 @@ def test_pipeline_serialization():
     assert c == n
 
 
+def test_collate_batch():
+    import numpy
+
+    batch = [
+        {
+            "data": numpy.arange(6, dtype="float32").reshape(3, 2),
+            "classes": numpy.array([1, 2, 3], dtype="uint32"),
+            "scalar": numpy.array(3, dtype="int32"),
+            "seq_tag": numpy.array("seq-0"),
+        },
+        {
+            "data": numpy.arange(10, dtype="float32").reshape(5, 2)[::-1],
+            "classes": numpy.array([4, 5, 6], dtype="uint32"),
+            "scalar": numpy.array(5, dtype="int32"),
+            "seq_tag": numpy.array("seq-1"),
+        },
+    ]
+    res = data_pipeline.collate_batch(batch)
+    print(res)
+    assert res["data"].shape == (2, 5, 2) and res["data"].dtype == torch.float32
+    assert res["data:seq_len"].tolist() == [3, 5] and res["data:seq_len"].dtype == torch.int32
+    assert res["data"][0, :3].tolist() == batch[0]["data"].tolist()
+    assert res["data"][0, 3:].abs().sum() == 0  # padding
+    assert res["data"][1].tolist() == batch[1]["data"].tolist()
+    assert res["classes"].tolist() == [[1, 2, 3], [4, 5, 6]] and res["classes"].dtype == torch.int64
+    assert res["classes:seq_len"].tolist() == [3, 3]
+    assert res["scalar"].tolist() == [3, 5]
+    assert isinstance(res["seq_tag"], numpy.ndarray) and res["seq_tag"].tolist() == ["seq-0", "seq-1"]
+
+
+def test_create_tensor():
+    import numpy
+
+    res = data_pipeline.create_tensor(numpy.array(3, dtype="int32"))
+    assert res.shape == () and res.dtype == torch.int32 and res.item() == 3
+    res = data_pipeline.create_tensor(numpy.array(3, dtype="uint32"))
+    assert res.shape == () and res.dtype == torch.int64 and res.item() == 3
+    array = numpy.arange(6, dtype="float32").reshape(3, 2)
+    res = data_pipeline.create_tensor(array)
+    assert res.data_ptr() == array.ctypes.data  # no copy
+    res = data_pipeline.create_tensor(array[::-1])
+    assert res.tolist() == array[::-1].tolist()
+
+
+def test_ChunkingIterDataPipe_non_chunked_data():
+    import numpy
+
+    seq = {
+        "data": numpy.arange(10, dtype="float32").reshape(5, 2),
+        "classes": numpy.array([1, 2, 3], dtype="int32"),
+    }
+    seq_orig = {key: value.copy() for key, value in seq.items()}
+    chunked_dataset = data_pipeline.ChunkingIterDataPipe(
+        dp.iter.IterableWrapper([seq], deepcopy=False), ({"data": 2}, {"data": 2})
+    )
+    chunks = list(chunked_dataset)
+    assert [chunk["data"].tolist() for chunk in chunks] == [[[0, 1], [2, 3]], [[4, 5], [6, 7]], [[8, 9]]]
+    # Non-chunked data is shared over all chunks, not copied.
+    assert all(chunk["classes"] is seq["classes"] for chunk in chunks)
+    # The further pipeline must not modify it inplace.
+    batch = data_pipeline.collate_batch(chunks)
+    batch["classes"] += 1
+    batch["data"] += 1
+    for key, value in seq.items():
+        assert value.tolist() == seq_orig[key].tolist()
+
+
+def test_ChunkingIterDataPipe_make_chunks():
+    import numpy
+
+    for seq_len in [0, 1, 5, 10, 11]:
+        data = numpy.arange(seq_len * 2).reshape(seq_len, 2)
+        for chunk_size in [1, 3, 5, 10]:
+            for chunk_step in [1, 2, 3, 5, 7]:
+                for min_chunk_size in [0, 2, 6]:
+                    ref_chunks = [
+                        data[start_index : start_index + chunk_size]
+                        for start_index in range(0, len(data), chunk_step)
+                        if len(data[start_index : start_index + chunk_size]) >= min_chunk_size
+                    ]
+                    # noinspection PyProtectedMember
+                    chunks = data_pipeline.ChunkingIterDataPipe._make_chunks(
+                        data, chunk_size, chunk_step, min_chunk_size
+                    )
+                    assert [chunk.tolist() for chunk in chunks] == [
+                        chunk.tolist() for chunk in ref_chunks
+                    ], f"seq_len {seq_len}, chunk size {chunk_size} step {chunk_step} min {min_chunk_size}"
+
+
+def test_BatchingIterDataPipe():
+    import numpy
+
+    seqs = [
+        {"data": numpy.zeros((seq_len, 2)), "classes": numpy.zeros((1,)), "seq_idx": numpy.array(seq_idx)}
+        for seq_idx, seq_len in enumerate([3, 4, 2, 6, 1])
+    ]
+
+    def _get_batches(**kwargs):
+        batches_dataset = data_pipeline.BatchingIterDataPipe(dp.iter.IterableWrapper(seqs, deepcopy=False), **kwargs)
+        return [[int(seq["seq_idx"]) for seq in batch] for batch in batches_dataset]
+
+    assert _get_batches(batch_size=8) == [[0, 1], [2], [3], [4]]
+    assert _get_batches(batch_size={"classes": 3}) == [[0, 1, 2], [3, 4]]  # no limit on data
+    assert _get_batches(batch_size={"data": 12, "classes": 2}) == [[0, 1], [2, 3], [4]]
+    assert _get_batches(batch_size=None, max_seqs=2) == [[0, 1], [2, 3], [4]]
+
+
+def test_BatchingIterDataPipe_collate():
+    import numpy
+
+    seqs = [
+        {"data": numpy.full((seq_len, 2), seq_idx, dtype="float32"), "seq_idx": numpy.array(seq_idx)}
+        for seq_idx, seq_len in enumerate([3, 4, 2, 6, 1])
+    ]
+    kwargs = dict(batch_size=8)
+    batches = data_pipeline.BatchingIterDataPipe(dp.iter.IterableWrapper(seqs, deepcopy=False), **kwargs)
+    collated = data_pipeline.BatchingIterDataPipe(dp.iter.IterableWrapper(seqs, deepcopy=False), collate=True, **kwargs)
+    collated = list(collated)
+    assert len(collated) == 4
+    for batch, res in zip(batches, collated):
+        ref = data_pipeline.collate_batch(batch)
+        assert set(res.keys()) == set(ref.keys()) == {"data", "data:seq_len", "seq_idx"}
+        for key in ref.keys():
+            assert torch.equal(res[key], ref[key])
+    assert collated[0]["data"].shape == (2, 4, 2)
+    assert collated[0]["data:seq_len"].tolist() == [3, 4]
+
+
+def test_ReturnnDatasetIterDataPipe_num_workers():
+    dataset = Task12AXDataset(num_seqs=11)
+    dataset.init_seq_order(epoch=1)
+    wrapped_dataset = returnn_dataset_wrapper.ReturnnDatasetIterDataPipe(dataset)
+    expected_seq_tags = [str(data["seq_tag"]) for data in wrapped_dataset]
+    assert len(expected_seq_tags) == 11
+
+    loader = torch.utils.data.DataLoader(wrapped_dataset, batch_size=None, num_workers=3)
+    seq_tags = [str(data["seq_tag"]) for data in loader]
+    print(seq_tags)
+    assert sorted(seq_tags) == sorted(expected_seq_tags)
+
+
 def test_HDFDataset():
     # https://github.com/rwth-i6/returnn/issues/1281
     from test_HDFDataset import generate_hdf_from_other, HDFDataset